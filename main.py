@@ -1,15 +1,22 @@
 import os
+import asyncio
 import hashlib
+import hmac
 import logging
-import json
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from typing import Dict, List, Tuple, Optional
+from urllib.parse import quote, urlencode
 
 from fastapi import FastAPI, Request, Response, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 import httpx
 import jwt
-from xml.etree import ElementTree as ET
-from xml.dom import minidom
+import orjson
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from dotenv import load_dotenv
 
 # ----------------------------------------------------------------------
@@ -20,6 +27,7 @@ from dotenv import load_dotenv
 #   AIRTABLE_API_KEY
 #   AIRTABLE_BASE_ID
 #   AIRTABLE_TABLE_NAME (опционально, по умолчанию "Payments")
+#   AIRTABLE_TYPECAST (опционально, "1" — PATCH с typecast, как раньше)
 # ----------------------------------------------------------------------
 load_dotenv()
 
@@ -28,6 +36,7 @@ INTEGRITY_CODE = os.getenv("MNT_INTEGRITY_CODE", "").strip()
 AIRTABLE_API_KEY = os.getenv("AIRTABLE_API_KEY", "").strip()
 AIRTABLE_BASE_ID = os.getenv("AIRTABLE_BASE_ID", "").strip()
 AIRTABLE_TABLE_NAME = os.getenv("AIRTABLE_TABLE_NAME", "Payments").strip()
+AIRTABLE_TYPECAST = os.getenv("AIRTABLE_TYPECAST", "0").strip() == "1"
 AUTH_URL = os.getenv("AUTH_URL", "").strip()
 PUBLIC_KEY = os.getenv("PUBLIC_KEY", "").replace("\\n", "\n").strip()
 
@@ -45,148 +54,437 @@ if not all([
         "AUTH_URL, PUBLIC_KEY"
     )
 
+# Разбираем PEM публичного ключа один раз, а не в каждом jwt.decode
+try:
+    _PUB_KEY = load_pem_public_key(PUBLIC_KEY.encode("utf-8"))
+except (ValueError, UnsupportedAlgorithm):
+    logging.critical("Не удалось разобрать PUBLIC_KEY как PEM публичный ключ")
+    _PUB_KEY = PUBLIC_KEY
+
 app = FastAPI()
 
+# URL базы и заголовки Airtable не меняются между запросами
+_AIRTABLE_BASE_URL = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/"
+_AIRTABLE_HEADERS = {
+    "Authorization": f"Bearer {AIRTABLE_API_KEY}",
+    "Content-Type": "application/json",
+}
+
+# Airtable принимает не больше 10 записей в одном PATCH
+_AIRTABLE_BATCH_SIZE = 10
+# Сколько пакетных PATCH может идти одновременно
+_AIRTABLE_MAX_IN_FLIGHT = 4
+# Сколько webhook ждёт результата своего обновления из фоновой задачи
+_AIRTABLE_UPDATE_TIMEOUT = 30.0
+
+# Кэш успешно обновлённых записей: record_id -> (истекает, сумма, статус, email).
+# LRU на OrderedDict: попадание переносит запись в конец, при переполнении
+# вытесняем самые давно использованные
+_EMAIL_CACHE_TTL = 3600.0
+_EMAIL_CACHE_MAX = 10_000
+_email_cache: OrderedDict[str, Tuple[float, str, str, str]] = OrderedDict()
+
+
+class _RecordLock:
+    """Блокировка записи и число запросов, которые её держат или ждут."""
+
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+# Блокировки по record_id: одновременные дубли нотификации ждут первую,
+# а не шлют в Airtable параллельные PATCH
+_email_locks: Dict[str, _RecordLock] = {}
+
+# Атрибут INVENTORY ответа на webhook: JSON, в котором меняется только цена
+_INVENTORY_TMPL = (
+    '[{"name":"Подписка на мероприятия","price":%s,"quantity":1,'
+    '"vatTag":"1105","pm":"full_payment","po":"commodity"}]'
+)
+
+# Постоянные параметры ссылки на оплату PayAnyWay
+_PAY_DEFAULTS = {
+    "MNT_ID": MNT_ID,
+    "MNT_CURRENCY_CODE": "RUB",
+    "MNT_TEST_MODE": "0",
+}
+
+# Экранирование строкового литерала в формулах Airtable ('...')
+_FORMULA_STR_ESCAPE = str.maketrans({"\\": "\\\\", "'": "\\'"})
+
+# Поля записи Payments, которые нужны странице инвойсов
+_INVOICE_FIELDS = [
+    "Amount",
+    "Method",
+    "Month",
+    "Resident",
+    "Name (from Resident)",
+    "Status",
+    "Payment Id",
+]
+
+# Экранирование текста внутри XML-элементов ответа Moneta.ru
+_XML_ESCAPE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&apos;",
+})
+
+# Шаблон XML-ответа Moneta.ru (схема фиксированная, ET/minidom не нужны)
+_XML_RESPONSE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    "<MNT_RESPONSE>\n"
+    "  <MNT_ID>{mnt_id}</MNT_ID>\n"
+    "  <MNT_TRANSACTION_ID>{mnt_trx_id}</MNT_TRANSACTION_ID>\n"
+    "  <MNT_RESULT_CODE>{result_code}</MNT_RESULT_CODE>\n"
+    "  <MNT_SIGNATURE>{mnt_sig}</MNT_SIGNATURE>\n"
+    "  <MNT_ATTRIBUTES>\n{attrs_xml}  </MNT_ATTRIBUTES>\n"
+    "</MNT_RESPONSE>\n"
+)
+
+# MD5 здесь — контрольная сумма протокола Moneta.ru, а не криптография:
+# usedforsecurity=False позволяет OpenSSL взять самую быструю реализацию
+# и не упирается в ограничения FIPS-сборок.
+# Заготовки MD5 с постоянными префиксами подписи: на каждый запрос
+# делается только copy() и update() переменной части.
+# Постоянный суффикс всех подписей кодируем один раз
+_INTEGRITY_B = INTEGRITY_CODE.encode("utf-8")
+# Входящий запрос: MD5(MNT_ID + ...)
+_SIG_PREFIX = hashlib.md5(MNT_ID.encode("utf-8"), usedforsecurity=False)
+# Ответ: MD5(MNT_RESULT_CODE + MNT_ID + ...) для кодов, которые мы отдаём
+_RESPONSE_SIG_PREFIX = {
+    code: hashlib.md5((code + MNT_ID).encode("utf-8"), usedforsecurity=False)
+    for code in ("200", "500")
+}
+
+# Ответ-ошибка для нашего MNT_ID: от запроса зависят только id транзакции и подпись
+_XML_FAIL = _XML_RESPONSE.format(
+    mnt_id=MNT_ID.translate(_XML_ESCAPE),
+    result_code="500",
+    attrs_xml="",
+    mnt_trx_id="{mnt_trx_id}",
+    mnt_sig="{mnt_sig}",
+)
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    # Общий клиент: соединения с Airtable переиспользуются между запросами,
+    # вместо нового TCP+TLS рукопожатия на каждый вызов. URL базы и
+    # авторизация зашиты в клиент, запросы указывают только путь таблицы.
+    app.state.airtable = httpx.AsyncClient(
+        base_url=_AIRTABLE_BASE_URL,
+        headers=_AIRTABLE_HEADERS,
+        timeout=10.0,
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=32,
+            max_connections=64,
+            keepalive_expiry=60,
+        ),
+    )
+    # Очередь обновлений записей: фоновая задача склеивает их в пакетные PATCH
+    app.state.patch_queue = asyncio.Queue()
+    app.state.patch_worker = asyncio.create_task(airtable_patch_worker(app.state.patch_queue))
+
 
-def calculate_signature(params: Dict[str, str]) -> str:
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    app.state.patch_worker.cancel()
+    try:
+        await app.state.patch_worker
+    except asyncio.CancelledError:
+        pass
+    await app.state.airtable.aclose()
+
+
+def calculate_signature(
+    mnt_trx_id: str,
+    mnt_op_id: str,
+    mnt_amount_str: str,
+    mnt_currency: str,
+    mnt_subscriber: str,
+    mnt_test_mode: str,
+) -> bytes:
     """
     Вычисляем MD5-подпись входящего запроса Moneta.ru:
     MD5(MNT_ID + MNT_TRANSACTION_ID + MNT_OPERATION_ID +
         MNT_AMOUNT + MNT_CURRENCY_CODE + MNT_SUBSCRIBER_ID +
         MNT_TEST_MODE + INTEGRITY_CODE)
 
-    Считаем, что params["MNT_AMOUNT"] уже передано как строка (с двумя знаками после точки).
+    Значения передаются строками "как есть" из запроса (MNT_AMOUNT — с двумя знаками после точки).
+    Возвращает сырой 16-байтный digest (для сравнения через hmac.compare_digest).
     """
-    mnt_trx_id     = params.get("MNT_TRANSACTION_ID", "")
-    mnt_op_id      = params.get("MNT_OPERATION_ID", "")
-    mnt_amount_str = params.get("MNT_AMOUNT", "")          # берем "как есть"
-    mnt_currency   = params.get("MNT_CURRENCY_CODE", "")
-    mnt_subscriber = params.get("MNT_SUBSCRIBER_ID", "")
-    mnt_test_mode  = params.get("MNT_TEST_MODE", "0")
-
+    # Одна f-строка собирается за одну аллокацию, без промежуточных строк
     data_to_sign = (
-        MNT_ID
-        + mnt_trx_id
-        + mnt_op_id
-        + mnt_amount_str
-        + mnt_currency
-        + mnt_subscriber
-        + mnt_test_mode
-        + INTEGRITY_CODE
+        f"{mnt_trx_id}{mnt_op_id}{mnt_amount_str}{mnt_currency}"
+        f"{mnt_subscriber}{mnt_test_mode}"
     )
-    return hashlib.md5(data_to_sign.encode("utf-8")).hexdigest()
+    # MNT_ID уже "впитан" в заготовку, копируем её вместо нового md5(),
+    # а INTEGRITY_CODE подаём готовыми байтами
+    sig = _SIG_PREFIX.copy()
+    sig.update(data_to_sign.encode("utf-8"))
+    sig.update(_INTEGRITY_B)
+    return sig.digest()
 
 
 def calc_payment_url(payment_id: str, amount: str, description: str, base_url: str) -> str:
     """Формирует ссылку на оплату PayAnyWay."""
     options = {
-        "MNT_ID": MNT_ID,
+        **_PAY_DEFAULTS,
         "MNT_TRANSACTION_ID": payment_id,
         "MNT_AMOUNT": amount,
         "MNT_DESCRIPTION": description,
-        "MNT_CURRENCY_CODE": "RUB",
-        "MNT_TEST_MODE": "0",
         "MNT_SUCCESS_URL": base_url,
         "MNT_FAIL_URL": base_url,
     }
-    # httpx.QueryParams does not provide a ``render`` method. ``str()`` will
-    # properly encode the parameters into a query string.
-    query_string = str(httpx.QueryParams(options))
-    return "https://www.payanyway.ru/assistant.htm?" + query_string
+    # Кодируем как httpx: пробел — %20, "/" не экранируем, ссылки не меняются
+    return "https://www.payanyway.ru/assistant.htm?" + urlencode(options, safe="/", quote_via=quote)
 
 
-async def update_airtable_record(record_id: str, amount: str, status: str) -> None:
+async def update_airtable_record(record_id: str, amount: str, status: str) -> Dict[str, object]:
     """
-    Обновление записи в Airtable:
-    PATCH https://api.airtable.com/v0/{BASE_ID}/{TABLE}/{record_id}
+    Обновление записи в Airtable.
+    Запись ставится в очередь, фоновая задача airtable_patch_worker отправляет
+    её пакетом вместе с другими ожидающими обновлениями:
+    PATCH https://api.airtable.com/v0/{BASE_ID}/{TABLE}
 
     Поля:
-      - Amount (строка, уже правильно отформатирована)
-      - Status ("Paid" или "Test Paid")
+      - Amount (число; при AIRTABLE_TYPECAST — строка как есть, Airtable приведёт сам)
+      - Status ("Paid" или "Test Paid", точное имя опции)
+
+    Без typecast Airtable не приводит типы на своей стороне и обновляет быстрее.
+    Без typecast некорректная MNT_AMOUNT падает на float() с ValueError
+    ещё до постановки в очередь — запрос в Airtable не уходит.
+
+    Возвращает поля обновлённой записи из ответа Airtable (включая lookup-поля),
+    чтобы не делать отдельный GET за той же записью.
+    Если обновление не удалось или не уложилось в _AIRTABLE_UPDATE_TIMEOUT,
+    выбрасывает HTTPException (500, либо 422, если Airtable отверг саму запись).
     """
-    airtable_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
-    headers = {
-        "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "typecast": True,
-        "fields": {
-            "Amount": amount,
-            "Status": status
-        }
+    fields = {
+        "Amount": amount if AIRTABLE_TYPECAST else float(amount),
+        "Status": status,
     }
+    future = asyncio.get_running_loop().create_future()
+    await app.state.patch_queue.put((record_id, fields, future))
+    try:
+        return await asyncio.wait_for(future, _AIRTABLE_UPDATE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=500, detail="Airtable update timed out")
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.patch(airtable_url, headers=headers, json=payload, timeout=10.0)
 
-    if resp.status_code not in (200, 201):
-        logging.error(
-            "Ошибка при обновлении Airtable (record_id=%s): %s %s",
-            record_id, resp.status_code, resp.text
-        )
-        raise HTTPException(status_code=500, detail="Airtable update failed")
+async def airtable_patch_worker(queue: asyncio.Queue) -> None:
+    """
+    Фоновая задача: забирает из очереди все накопившиеся обновления (до
+    _AIRTABLE_BATCH_SIZE записей, Airtable больше не принимает) и отправляет
+    их одним PATCH. Одновременно идёт не больше _AIRTABLE_MAX_IN_FLIGHT
+    запросов: пока все заняты, обновления копятся в очереди, так что при
+    всплеске нотификаций запросов к Airtable в разы меньше, а одиночное
+    обновление уходит сразу, без ожидания. Медленный пакет не задерживает
+    следующие.
+    """
+    slots = asyncio.Semaphore(_AIRTABLE_MAX_IN_FLIGHT)
+    in_flight = set()
 
-async def get_airtable_email(record_id: str) -> str:
+    async def send(batch):
+        try:
+            await flush_patch_batch(batch)
+        finally:
+            slots.release()
+
+    carry = None
+    try:
+        while True:
+            await slots.acquire()
+            first = carry if carry is not None else await queue.get()
+            carry = None
+            batch = [first]
+            ids = {first[0]}
+            while len(batch) < _AIRTABLE_BATCH_SIZE and not queue.empty():
+                item = queue.get_nowait()
+                if item[0] in ids:
+                    # Одну запись дважды в пакет не кладём — уйдёт следующим
+                    carry = item
+                    break
+                ids.add(item[0])
+                batch.append(item)
+
+            task = asyncio.create_task(send(batch))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def flush_patch_batch(
+    batch: List[Tuple[str, Dict[str, object], "asyncio.Future[Dict[str, object]]"]]
+) -> None:
+    """Отправляет пакет и передаёт каждому ожидающему поля его записи или ошибку."""
+    try:
+        updated = await patch_airtable_records([(record_id, fields) for record_id, fields, _ in batch])
+    except Exception as e:
+        if len(batch) > 1 and isinstance(e, HTTPException) and e.status_code == 422:
+            # Airtable отверг одну из записей и с ней весь пакет: повторяем
+            # по одной, чтобы остальные платежи не страдали из-за неё.
+            # Сетевые ошибки, 429 и 5xx так не дробим — они общие для пакета.
+            # Одиночные PATCH идут разом: по очереди последние в пакете не
+            # уложились бы в _AIRTABLE_UPDATE_TIMEOUT своих webhook
+            await asyncio.gather(*(flush_patch_batch([item]) for item in batch))
+            return
+        updated = {}
+        error = e
+    else:
+        error = HTTPException(status_code=500, detail="Airtable update failed")
+
+    for record_id, _, future in batch:
+        if future.done():
+            # Ожидающий webhook уже отменён (клиент отключился или истёк таймаут)
+            continue
+        if record_id in updated:
+            future.set_result(updated[record_id])
+        else:
+            future.set_exception(error)
+
+
+async def patch_airtable_records(records: List[Tuple[str, Dict[str, object]]]) -> Dict[str, Dict[str, object]]:
     """
-    Асинхронно получает запись из таблицы Payments (Airtable) по record_id
-    и возвращает значение поля 'Email'. Если поле не найдено или запрос провалился,
-    выбрасывает HTTPException(404) или HTTPException(500).
+    Обновляет до 10 записей одним запросом:
+    PATCH https://api.airtable.com/v0/{BASE_ID}/{TABLE}
+
+    Возвращает словарь record_id -> поля обновлённой записи.
+    Если Airtable отверг записи пакета, выбрасывает HTTPException(422),
+    при прочих сбоях — HTTPException(500).
     """
-    # Составляем URL: https://api.airtable.com/v0/{BASE_ID}/{TABLE_NAME}/{record_id}
-    airtable_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
-    headers = {
-        "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-        "Content-Type": "application/json"
+    payload: Dict[str, object] = {
+        "records": [{"id": record_id, "fields": fields} for record_id, fields in records],
     }
+    if AIRTABLE_TYPECAST:
+        payload["typecast"] = True
 
-    # Делаем GET-запрос к Airtable
-    async with httpx.AsyncClient() as client:
-        response = await client.get(airtable_url, headers=headers, timeout=10.0)
-
-    # Если статус ответа не 200, выбрасываем ошибку
-    if response.status_code == 404:
-        # Запись не найдена
-        raise HTTPException(status_code=404, detail=f"Record {record_id} not found in Airtable")
-    if response.status_code != 200:
-        # Другая ошибка на стороне Airtable
-        raise HTTPException(
-            status_code=500,
-            detail=f"Airtable GET failed: {response.status_code} {response.text}"
+    resp = await app.state.airtable.patch(AIRTABLE_TABLE_NAME, content=orjson.dumps(payload))
+
+    if resp.status_code not in (200, 201):
+        logging.error(
+            "Ошибка при обновлении Airtable (record_ids=%s): %s %s",
+            [record_id for record_id, _ in records], resp.status_code, resp.text
         )
+        if _is_record_rejection(resp):
+            raise HTTPException(status_code=422, detail="Airtable rejected record")
+        raise HTTPException(status_code=500, detail="Airtable update failed")
 
-    # Парсим JSON-ответ
     try:
-        data = response.json()
-    except json.JSONDecodeError:
+        data = orjson.loads(resp.content)
+        return {rec["id"]: rec.get("fields", {}) for rec in data.get("records", [])}
+    except (orjson.JSONDecodeError, AttributeError, KeyError, TypeError):
         raise HTTPException(status_code=500, detail="Invalid JSON from Airtable")
 
-    # Проходим по ключу "fields" и ищем "Email"
-    fields = data.get("fields", {})
+
+def _is_record_rejection(resp: httpx.Response) -> bool:
+    """
+    Отказ Airtable из-за содержимого пакета: любой 4xx (422, 400 INVALID_*,
+    404 на удалённую запись и т.п.), кроме авторизации (401/403) и лимитов
+    (429). Сбои сервера (5xx) — тоже не отказ записи.
+    """
+    return 400 <= resp.status_code < 500 and resp.status_code not in (401, 403, 429)
+
+
+def get_record_email(fields: Dict[str, object], record_id: str) -> str:
+    """
+    Возвращает email резидента из полей записи Payments (lookup 'Email (from Resident)').
+    Если поле не найдено или пустое, выбрасывает HTTPException(404).
+    """
     email = fields.get("Email (from Resident)")
-    if not email:
+    if not email or not email[0]:
         # Поле Email отсутствует или пустое
         raise HTTPException(status_code=404, detail=f"Email not found in record {record_id}")
 
     return email[0]
 
 
+def get_cached_email(record_id: str, amount: str, status: str) -> Optional[str]:
+    """
+    Возвращает email из кэша, если запись недавно уже обновлялась с теми же
+    суммой и статусом (повторная нотификация Moneta.ru) — PATCH можно не делать.
+    """
+    hit = _email_cache.get(record_id)
+    if hit and hit[0] > time.monotonic() and hit[1] == amount and hit[2] == status:
+        _email_cache.move_to_end(record_id)
+        return hit[3]
+    return None
+
+
+@asynccontextmanager
+async def record_lock(record_id: str):
+    """
+    Сериализует обработку нотификаций по одной записи. Блокировка удаляется
+    из _email_locks, только когда её больше никто не держит и не ждёт —
+    иначе новый дубль получил бы свежий lock и пошёл параллельно с ожидающим.
+    """
+    entry = _email_locks.get(record_id)
+    if entry is None:
+        entry = _email_locks[record_id] = _RecordLock()
+    entry.users += 1
+    try:
+        async with entry.lock:
+            yield
+    finally:
+        entry.users -= 1
+        if entry.users == 0 and _email_locks.get(record_id) is entry:
+            del _email_locks[record_id]
+
+
+def cache_email(record_id: str, amount: str, status: str, email: str) -> None:
+    """Запоминает результат успешного обновления записи на _EMAIL_CACHE_TTL секунд."""
+    _email_cache.pop(record_id, None)
+    _email_cache[record_id] = (time.monotonic() + _EMAIL_CACHE_TTL, amount, status, email)
+    while len(_email_cache) > _EMAIL_CACHE_MAX:
+        _email_cache.popitem(last=False)
+
+
 async def find_invoices(username: str, user_id: str) -> List[Dict[str, object]]:
     """Возвращает записи из Airtable для пользователя."""
-    base_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
-    headers = {
-        "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-        "Content-Type": "application/json",
+    # Ищем "@username" или id пользователя одним REGEX_MATCH: Airtable
+    # вычисляет ARRAYJOIN(ARRAYUNIQUE(...)) один раз вместо двух FIND.
+    # Пустые значения в шаблон не попадают — иначе он совпал бы с любой записью
+    alternatives = []
+    if username:
+        alternatives.append("@" + re.escape(username))
+    if user_id:
+        alternatives.append(re.escape(user_id))
+    if not alternatives:
+        return []
+    pattern = "|".join(alternatives).translate(_FORMULA_STR_ESCAPE)
+    formula = f"REGEX_MATCH(ARRAYJOIN(ARRAYUNIQUE({{Telegram Username (from Resident)}})), '{pattern}')"
+    # Запрашиваем только поля, которые выводятся на странице
+    params: Dict[str, object] = {
+        "filterByFormula": formula,
+        "fields[]": _INVOICE_FIELDS,
+        "pageSize": 100,
     }
-
-    async with httpx.AsyncClient() as client:
-        formula = f"OR(FIND('@{username}', ARRAYJOIN(ARRAYUNIQUE({{Telegram Username (from Resident)}}))), FIND('{user_id}', ARRAYJOIN(ARRAYUNIQUE({{Telegram Username (from Resident)}}))))"
-        resp = await client.get(base_url, headers=headers, params={"filterByFormula": formula})
+    data: List[Dict[str, object]] = []
+    # Airtable отдаёт не больше 100 записей за раз, остальное — по offset
+    while True:
+        resp = await app.state.airtable.get(AIRTABLE_TABLE_NAME, params=params)
         if resp.status_code != 200:
             logging.error("Airtable search failed: %s %s", resp.status_code, resp.text)
             return []
-        data = resp.json().get("records", [])
-    return data
+        try:
+            page = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            logging.error("Airtable search returned invalid JSON")
+            return []
+        data.extend(page.get("records", []))
+        offset = page.get("offset")
+        if not offset:
+            return data
+        params["offset"] = offset
 
 
 def build_xml_response(
@@ -194,7 +492,7 @@ def build_xml_response(
     mnt_trx_id: str,
     result_code: str,
     attributes: Optional[Dict[str, str]] = None
-) -> str:
+) -> bytes:
     """
     Формирует XML-ответ Moneta.ru по новой спецификации:
 
@@ -215,37 +513,145 @@ def build_xml_response(
 
     Подпись считается как MD5(MNT_RESULT_CODE + MNT_ID + MNT_TRANSACTION_ID + INTEGRITY_CODE).
     Значения атрибутов в <VALUE> не должны содержать кавычек, символов &, $, #, /, \.
+
+    Возвращает готовые UTF-8 байты: Response отдаёт их без повторного кодирования.
     """
-    # 1. Создаём корень <MNT_RESPONSE>
-    root = ET.Element("MNT_RESPONSE")
-
-    # 2. Добавляем MNT_ID и MNT_TRANSACTION_ID
-    ET.SubElement(root, "MNT_ID").text = mnt_id
-    ET.SubElement(root, "MNT_TRANSACTION_ID").text = mnt_trx_id
-
-    # 3. Добавляем MNT_RESULT_CODE
-    ET.SubElement(root, "MNT_RESULT_CODE").text = result_code
-
-    # 4. Вычисляем подпись
-    sign_src = result_code + mnt_id + mnt_trx_id + INTEGRITY_CODE
-    mnt_sig = hashlib.md5(sign_src.encode("utf-8")).hexdigest()
-    ET.SubElement(root, "MNT_SIGNATURE").text = mnt_sig
-
-    # 5. Формируем блок MNT_ATTRIBUTES
-    attrs_elem = ET.SubElement(root, "MNT_ATTRIBUTES")
-    if attributes:
-        # Для каждого ключа и строки-значения создаём <ATTRIBUTE>
-        for key, value_str in attributes.items():
-            attr = ET.SubElement(attrs_elem, "ATTRIBUTE")
-            ET.SubElement(attr, "KEY").text = key
-            ET.SubElement(attr, "VALUE").text = value_str
+    # 1. Вычисляем подпись
+    prefix = _RESPONSE_SIG_PREFIX.get(result_code) if mnt_id == MNT_ID else None
+    if prefix is not None:
+        sig = prefix.copy()
+        sig.update(mnt_trx_id.encode("utf-8"))
+    else:
+        sig = hashlib.md5(
+            f"{result_code}{mnt_id}{mnt_trx_id}".encode("utf-8"),
+            usedforsecurity=False,
+        )
+    sig.update(_INTEGRITY_B)
+    mnt_sig = sig.hexdigest()
+
+    # 2. Формируем блок MNT_ATTRIBUTES
     # Если attributes=None или пустой dict — <MNT_ATTRIBUTES/> будет пустым
+    attrs_xml = "".join(
+        f"    <ATTRIBUTE><KEY>{key.translate(_XML_ESCAPE)}</KEY>"
+        f"<VALUE>{value_str.translate(_XML_ESCAPE)}</VALUE></ATTRIBUTE>\n"
+        for key, value_str in (attributes or {}).items()
+    )
+
+    # 3. Подставляем значения в шаблон
+    return _XML_RESPONSE.format(
+        mnt_id=mnt_id.translate(_XML_ESCAPE),
+        mnt_trx_id=mnt_trx_id.translate(_XML_ESCAPE),
+        result_code=result_code,
+        mnt_sig=mnt_sig,
+        attrs_xml=attrs_xml,
+    ).encode("utf-8")
 
-    # 6. Преобразуем ElementTree в разбитый по отступам XML
-    rough_xml = ET.tostring(root, encoding="utf-8")
-    parsed = minidom.parseString(rough_xml)
-    pretty_bytes = parsed.toxml(encoding="utf-8")
-    return pretty_bytes.decode("utf-8")
+
+def xml_fail_response(mnt_trx_id: str) -> Response:
+    """
+    XML-ответ с MNT_RESULT_CODE=500 для нашего MNT_ID.
+    То же, что build_xml_response(MNT_ID, mnt_trx_id, "500"), но по заранее
+    подготовленному шаблону и префиксу подписи.
+    """
+    sig = _RESPONSE_SIG_PREFIX["500"].copy()
+    sig.update(mnt_trx_id.encode("utf-8"))
+    sig.update(_INTEGRITY_B)
+    xml_fail = _XML_FAIL.format(
+        mnt_trx_id=mnt_trx_id.translate(_XML_ESCAPE),
+        mnt_sig=sig.hexdigest(),
+    ).encode("utf-8")
+    return Response(content=xml_fail, status_code=200, media_type="application/xml")
+
+
+# Статичные части страницы инвойсов: собираются один раз при импорте
+_HTML_HEAD = """<!DOCTYPE html>
+<html lang='en'>
+<head>
+    <meta charset='utf-8'>
+    <meta name='viewport' content='width=device-width, initial-scale=1'>
+    <title>Invoices</title>
+    <style>
+        body { font-family: Arial, sans-serif; padding: 20px; }
+        table { border-collapse: collapse; width: 100%; }
+        .table-container { overflow-x: auto; }
+        th, td { border: 1px solid #ccc; padding: 8px 12px; text-align: left; }
+        th { background-color: #f5f5f5; }
+        a.pay-link { color: white; background: #007bff; padding: 4px 8px; border-radius: 4px; text-decoration: none; }
+        .no-pay { color: #777; font-style: italic; }
+        .paid-row { background-color: #e6ffed; }
+        .unpaid-row { background-color: #ffecec; }
+        .test-paid-row { background-color: #fff9e6; }
+        @media (max-width: 600px) {
+            body { padding: 10px; }
+            th, td { padding: 6px 8px; }
+            a.pay-link { display: inline-block; margin-top: 4px; }
+        }
+    </style>
+</head>
+<body>
+    <h1>Ваши инвойсы</h1>
+    <div class="table-container">
+    <table>
+        <tr>
+            <th>Резидент</th><th>Месяц</th><th>Способ</th><th>Сумма</th><th>Статус</th><th></th>
+        </tr>
+"""
+_HTML_TAIL = """    </table>
+    </div>
+</body>
+</html>
+"""
+
+
+# CSS-класс строки таблицы по статусу платежа
+_ROW_CLASS = {
+    "Paid": "paid-row",
+    "Unpaid": "unpaid-row",
+    "Test Paid": "test-paid-row",
+}
+
+# Строка-заглушка для записи, которую не удалось отрисовать
+_ROW_ERROR = "<tr><td colspan='6' class='no-pay'>Не удалось показать инвойс</td></tr>\n"
+
+
+def _format_row(rec: Dict[str, object], base_url: str) -> str:
+    """Формирует строку <tr> таблицы инвойсов для одной записи Airtable."""
+    f = rec.get("fields", {})
+    amount = f.get("Amount")
+    method = f.get("Method")
+    month = f.get("Month")
+
+    resident_val = f.get("Resident")
+    if isinstance(resident_val, list):
+        resident = ", ".join(resident_val)
+    else:
+        resident = resident_val
+
+    # Если поле содержит id записи Airtable, пробуем взять имя из lookup
+    if resident and isinstance(resident, str) and resident.startswith("rec"):
+        name_field = f.get("Name (from Resident)")
+        if name_field:
+            resident = ", ".join(name_field) if isinstance(name_field, list) else name_field
+
+    status = f.get("Status")
+    pay_link = ""
+    if status == "Unpaid" and method == "Auto Credit Card":
+        description = f"Резидентство за {month} ({resident})"
+        pay_link = calc_payment_url(
+            str(f.get("Payment Id")), f"{float(amount):.2f}", description, base_url
+        )
+
+    link_html = (
+        f'<a class="pay-link" href="{pay_link}">Оплатить</a>'
+        if pay_link
+        else '<span class="no-pay">Не оплачивается</span>'
+    )
+
+    row_class = _ROW_CLASS.get(status, "")
+    return (
+        f"<tr class='{row_class}'><td>{resident}</td><td>{month}</td>"
+        f"<td>{method}</td><td>{amount}</td><td>{status}</td><td>{link_html}</td></tr>\n"
+    )
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -257,7 +663,7 @@ async def invoices(request: Request) -> Response:
             status_code=302,
         )
     try:
-        payload = jwt.decode(token, PUBLIC_KEY, algorithms=["RS256"])
+        payload = jwt.decode(token, _PUB_KEY, algorithms=["RS256"])
     except Exception as e:
         return RedirectResponse(
             url=f"{AUTH_URL}?redirect_uri={request.url}&error={e!r}",
@@ -268,146 +674,86 @@ async def invoices(request: Request) -> Response:
     user_id = payload.get("id")
 
     records = await find_invoices(username or "", str(user_id or ""))
-    rows = []
-    for rec in records:
-        f = rec.get("fields", {})
-        amount = f.get("Amount")
-        method = f.get("Method")
-        month = f.get("Month")
-
-        resident_val = f.get("Resident")
-        if isinstance(resident_val, list):
-            resident = ", ".join(resident_val)
-        else:
-            resident = resident_val
-
-        # Если поле содержит id записи Airtable, пробуем взять имя из lookup
-        if resident and isinstance(resident, str) and resident.startswith("rec"):
-            name_field = f.get("Name (from Resident)")
-            if name_field:
-                resident = ", ".join(name_field) if isinstance(name_field, list) else name_field
-
-        status = f.get("Status")
-        pay_link = ""
-        if status == "Unpaid" and f.get("Method") == "Auto Credit Card":
-            description = f"Резидентство за {month} ({resident})"
-            pay_link = calc_payment_url(
-                str(f.get("Payment Id")), f"{float(amount):.2f}", description, request.base_url
-            )
-
-        link_html = (
-            f'<a class="pay-link" href="{pay_link}">Оплатить</a>'
-            if pay_link
-            else '<span class="no-pay">Не оплачивается</span>'
-        )
+    base_url = str(request.base_url)
 
-        row_class = ""
-        if status == "Paid":
-            row_class = "paid-row"
-        elif status == "Unpaid":
-            row_class = "unpaid-row"
-        elif status == "Test Paid":
-            row_class = "test-paid-row"
-
-        rows.append(
-            f"<tr class='{row_class}'><td>{resident}</td><td>{month}</td>"
-            f"<td>{method}</td><td>{amount}</td><td>{status}</td><td>{link_html}</td></tr>"
-        )
+    # Отдаём страницу по частям: шапка уходит сразу, строки — по одной,
+    # целиком HTML в памяти не собирается
+    async def render():
+        yield _HTML_HEAD
+        for rec in records:
+            # Заголовки и 200 уже отправлены: битая запись не должна обрывать
+            # страницу, вместо неё выводим строку-заглушку
+            try:
+                row = _format_row(rec, base_url)
+            except Exception:
+                logging.exception("Invoice row render failed: %s", rec.get("id"))
+                row = _ROW_ERROR
+            yield row
+        yield _HTML_TAIL
 
-    table_rows = "".join(rows)
-    html_content = f"""
-    <!DOCTYPE html>
-    <html lang='en'>
-    <head>
-        <meta charset='utf-8'>
-        <meta name='viewport' content='width=device-width, initial-scale=1'>
-        <title>Invoices</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; padding: 20px; }}
-            table {{ border-collapse: collapse; width: 100%; }}
-            .table-container {{ overflow-x: auto; }}
-            th, td {{ border: 1px solid #ccc; padding: 8px 12px; text-align: left; }}
-            th {{ background-color: #f5f5f5; }}
-            a.pay-link {{ color: white; background: #007bff; padding: 4px 8px; border-radius: 4px; text-decoration: none; }}
-            .no-pay {{ color: #777; font-style: italic; }}
-            .paid-row {{ background-color: #e6ffed; }}
-            .unpaid-row {{ background-color: #ffecec; }}
-            .test-paid-row {{ background-color: #fff9e6; }}
-            @media (max-width: 600px) {{
-                body {{ padding: 10px; }}
-                th, td {{ padding: 6px 8px; }}
-                a.pay-link {{ display: inline-block; margin-top: 4px; }}
-            }}
-        </style>
-    </head>
-    <body>
-        <h1>Ваши инвойсы</h1>
-        <div class="table-container">
-        <table>
-            <tr>
-                <th>Резидент</th><th>Месяц</th><th>Способ</th><th>Сумма</th><th>Статус</th><th></th>
-            </tr>
-            {table_rows}
-        </table>
-        </div>
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
+    return StreamingResponse(render(), media_type="text/html")
+
+
+@app.get("/healthz")
+async def healthz() -> Response:
+    """Отдельный эндпоинт для health check'ов, чтобы пробы не ходили в /webhook."""
+    return Response(status_code=200, content="OK", media_type="text/plain")
 
 
 @app.api_route("/webhook", methods=["GET", "POST"])
 async def moneta_webhook(request: Request) -> Response:
     """
     Эндпоинт /webhook:
-    1) Если ни один параметр не передан (ни в query, ни в form-data, ни в JSON) -
-       возвращаем 200 OK (health check) с text/plain.
-    2) Иначе:
-       a) Собираем параметры в словарь.
-       b) Проверяем MNT_ID и MNT_SIGNATURE.
-       c) Обновляем запись в Airtable.
-       d) Формируем XML-ответ по новой схеме и возвращаем с Content-Type: application/xml.
+    1) Собираем параметры (query, form-data, JSON) в словарь за один проход.
+    2) Если ни один параметр не передан - возвращаем 200 OK (health check) с text/plain.
+    3) Иначе:
+       a) Проверяем MNT_ID и MNT_SIGNATURE.
+       b) Обновляем запись в Airtable.
+       c) Формируем XML-ответ по новой схеме и возвращаем с Content-Type: application/xml.
     """
-    # 1. Health check: нет ни query_params, ни form-data, ни JSON
-    has_query = len(request.query_params) > 0
-    has_form = False
-    has_json = False
-
-    content_type = request.headers.get("content-type", "")
-
-    if content_type.startswith("application/x-www-form-urlencoded"):
-        form_data = await request.form()
-        has_form = len(form_data) > 0
-    elif content_type.startswith("application/json"):
-        try:
-            json_body = await request.json()
-            has_json = isinstance(json_body, dict) and len(json_body) > 0
-        except Exception:
-            has_json = False
-
-    if not (has_query or has_form or has_json):
-        # Определили как health check
+    # 0. Быстрый health check: GET без query-параметров, тело не читаем
+    if request.method == "GET" and not request.query_params:
         return Response(status_code=200, content="OK", media_type="text/plain")
 
-    # 2. Сбор всех параметров в единый словарь строковых значений
-    params: Dict[str, str] = {}
-    # 2.1. Query-параметры
-    for k, v in request.query_params.items():
-        params[k] = v
-    # 2.2. Form-data (если есть)
-    if content_type.startswith("application/x-www-form-urlencoded") and has_form:
-        for k, v in form_data.items():
-            params[k] = v
-    # 2.3. JSON (если есть)
-    if content_type.startswith("application/json") and has_json:
-        for k, v in json_body.items():
-            params[k] = str(v)
+    # Тип тела определяем один раз, по MIME-типу без параметров (charset и т.п.)
+    content_type = request.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    is_form = content_type == "application/x-www-form-urlencoded"
+    is_json = content_type == "application/json"
+
+    # Без form/JSON тела подпись может прийти только в query. Если параметры
+    # есть, а подписи среди них нет, запрос заведомо не пройдёт проверку
+    if not (is_form or is_json) and request.query_params and "MNT_SIGNATURE" not in request.query_params:
+        return Response(status_code=400, content="FAIL", media_type="text/plain")
+
+    # 1. Сбор всех параметров в единый словарь строковых значений
+    # 1.1. Query-параметры
+    params: Dict[str, str] = dict(request.query_params.multi_items())
+    # 1.2. Form-data (если есть)
+    if is_form:
+        params.update((await request.form()).multi_items())
+    # 1.3. JSON (если есть; учитываем только объект, битое тело игнорируем)
+    elif is_json:
+        body = await request.body()
+        if body:
+            try:
+                json_body = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                json_body = None
+            if isinstance(json_body, dict):
+                params.update((k, str(v)) for k, v in json_body.items())
+
+    # 2. Health check: нет ни query_params, ни form-data, ни JSON
+    if not params:
+        return Response(status_code=200, content="OK", media_type="text/plain")
 
     # 3. Извлекаем обязательные поля
     mnt_id_rx        = params.get("MNT_ID", "")
     mnt_trx_id_rx    = params.get("MNT_TRANSACTION_ID", "")
-    mnt_signature_rx = params.get("MNT_SIGNATURE", "").lower()
+    mnt_op_id_rx     = params.get("MNT_OPERATION_ID", "")
+    mnt_signature_rx = params.get("MNT_SIGNATURE", "")
     mnt_amount_rx    = params.get("MNT_AMOUNT", "")
+    mnt_currency_rx  = params.get("MNT_CURRENCY_CODE", "")
+    mnt_subscr_rx    = params.get("MNT_SUBSCRIBER_ID", "")
     mnt_test_mode_rx = params.get("MNT_TEST_MODE", "0")
 
     # 4. Проверка MNT_ID
@@ -422,63 +768,57 @@ async def moneta_webhook(request: Request) -> Response:
         return Response(content=xml_fail, status_code=200, media_type="application/xml")
 
     # 5. Проверка подписи входящего запроса
-    calc_sig = calculate_signature(params)
-    if calc_sig != mnt_signature_rx:
-        logging.error(f"Signature mismatch: {calc_sig} expected, got {mnt_signature_rx}")
-        xml_fail = build_xml_response(
-            mnt_id=MNT_ID,
-            mnt_trx_id=mnt_trx_id_rx or "",
-            result_code="500",
-            attributes=None
-        )
-        return Response(content=xml_fail, status_code=200, media_type="application/xml")
+    # Сравниваем сырые digest'ы за постоянное время (без утечки по таймингу)
+    try:
+        recv_sig = bytes.fromhex(mnt_signature_rx)
+    except ValueError:
+        recv_sig = b""
+    calc_sig = calculate_signature(
+        mnt_trx_id_rx,
+        mnt_op_id_rx,
+        mnt_amount_rx,
+        mnt_currency_rx,
+        mnt_subscr_rx,
+        mnt_test_mode_rx,
+    )
+    if not hmac.compare_digest(calc_sig, recv_sig):
+        logging.error(f"Signature mismatch: {calc_sig.hex()} expected, got {mnt_signature_rx}")
+        return xml_fail_response(mnt_trx_id_rx)
 
-    email = await get_airtable_email(mnt_trx_id_rx)
-    
     # 6. Обновляем Airtable
     status_value = "Test Paid" if mnt_test_mode_rx == "1" else "Paid"
-    try:
-        # Передаём сумму как строку (она уже в нужном формате)
-        await update_airtable_record(
-            record_id=mnt_trx_id_rx,
-            amount=mnt_amount_rx,
-            status=status_value
-        )
-    except HTTPException as e:
-        logging.exception("Airtable update HTTPException")
-        xml_fail = build_xml_response(
-            mnt_id=MNT_ID,
-            mnt_trx_id=mnt_trx_id_rx,
-            result_code="500",
-            attributes=None
-        )
-        return Response(content=xml_fail, status_code=200, media_type="application/xml")
-    except Exception:
-        logging.exception("Airtable update Exception")
-        xml_fail = build_xml_response(
-            mnt_id=MNT_ID,
-            mnt_trx_id=mnt_trx_id_rx,
-            result_code="500",
-            attributes=None
-        )
-        return Response(content=xml_fail, status_code=200, media_type="application/xml")
+    async with record_lock(mnt_trx_id_rx):
+        # Повтор той же нотификации: запись уже обновлена, email известен
+        email = get_cached_email(mnt_trx_id_rx, mnt_amount_rx, status_value)
+        if email is None:
+            try:
+                # Сумма приходит строкой; в число её переводит update_airtable_record
+                # (или Airtable при AIRTABLE_TYPECAST)
+                fields = await update_airtable_record(
+                    record_id=mnt_trx_id_rx,
+                    amount=mnt_amount_rx,
+                    status=status_value
+                )
+                # Email берём из ответа PATCH — отдельный GET к Airtable не нужен.
+                # Нет email — тоже FAIL в XML: без CUSTOMER чек не отправить,
+                # Moneta.ru повторяет нотификацию, пока email не появится
+                email = get_record_email(fields, mnt_trx_id_rx)
+            except HTTPException as e:
+                logging.exception("Airtable update HTTPException")
+                return xml_fail_response(mnt_trx_id_rx)
+            except Exception:
+                logging.exception("Airtable update Exception")
+                return xml_fail_response(mnt_trx_id_rx)
+
+            cache_email(mnt_trx_id_rx, mnt_amount_rx, status_value, email)
 
     # 7. Подготавливаем атрибуты для XML-ответа
     attributes: Dict[str, str] = {
-        # INVENTORY и CLIENT должны быть валидным JSON-массивом в виде строки
-        "INVENTORY": json.dumps([{
-            "name": "Подписка на мероприятия",
-            "price": float(mnt_amount_rx),
-            "quantity": 1,
-            "vatTag": "1105",
-            "pm": "full_payment",
-            "po": "commodity"
-        }]), 
+        # INVENTORY — валидный JSON-массив в виде строки, меняется только цена
+        "INVENTORY": _INVENTORY_TMPL % (float(mnt_amount_rx),),
         # CUSTOMER — email покупателя
-        "CUSTOMER": email,  
+        "CUSTOMER": email,
     }
-    # Если какое-то значение пустое, Moneta всё равно пропустит, но можно убрать пустые ключи:
-    attributes = {k: v for k, v in attributes.items() if v}
 
     # 8. Успешный XML-ответ
     xml_success = build_xml_response(
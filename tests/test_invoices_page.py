@@ -0,0 +1,35 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_broken_row_renders_placeholder(monkeypatch):
+    records = [
+        {"id": "recOk", "fields": {"Resident": "Alice", "Month": "May", "Amount": 10, "Status": "Paid"}},
+        # Без Amount float() в _format_row падает
+        {"id": "recBad", "fields": {"Method": "Auto Credit Card", "Status": "Unpaid", "Payment Id": "1"}},
+        {"id": "recLast", "fields": {"Resident": "Bob", "Month": "June", "Amount": 20, "Status": "Paid"}},
+    ]
+
+    async def find_invoices(username, user_id):
+        return records
+
+    monkeypatch.setattr(main.jwt, "decode", lambda *args, **kwargs: {"username": "alice", "id": 1})
+    monkeypatch.setattr(main, "find_invoices", find_invoices)
+
+    resp = TestClient(main.app).get("/", cookies={"token": "t"})
+
+    assert resp.status_code == 200
+    assert "Alice" in resp.text
+    assert "Bob" in resp.text
+    assert main._ROW_ERROR in resp.text
+    assert resp.text.endswith(main._HTML_TAIL)
+
+
+def test_payment_url_encodes_like_httpx():
+    url = main.calc_payment_url("rec1", "1500.00", "Резидентство за May (Ann)", "https://pay.example.org/")
+
+    assert "MNT_DESCRIPTION=%D0%A0" in url
+    assert "%20%D0%B7%D0%B0%20May%20%28Ann%29" in url
+    assert "MNT_SUCCESS_URL=https%3A//pay.example.org/" in url
+    assert "+" not in url
@@ -0,0 +1,157 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+class FakeAirtable:
+    """Подменяет app.state.airtable: записывает пакеты и отвечает по правилам теста."""
+
+    def __init__(self, respond=None, delay=0.01):
+        self.calls = []
+        self.respond = respond or self.ok
+        self.delay = delay
+
+    @staticmethod
+    def ok(ids):
+        records = [{"id": rid, "fields": {"Email (from Resident)": [f"{rid}@example.com"]}} for rid in ids]
+        return httpx.Response(200, content=orjson.dumps({"records": records}))
+
+    async def patch(self, path, content):
+        ids = [rec["id"] for rec in orjson.loads(content)["records"]]
+        self.calls.append(ids)
+        delay = self.delay(ids) if callable(self.delay) else self.delay
+        await asyncio.sleep(delay)
+        return self.respond(ids)
+
+
+def run_updates(fake, record_ids):
+    """Ставит обновления в очередь разом и возвращает результаты (или исключения)."""
+
+    async def scenario():
+        main.app.state.airtable = fake
+        main.app.state.patch_queue = asyncio.Queue()
+        worker = asyncio.create_task(main.airtable_patch_worker(main.app.state.patch_queue))
+        try:
+            return await asyncio.gather(
+                *[main.update_airtable_record(rid, "1500.00", "Paid") for rid in record_ids],
+                return_exceptions=True,
+            )
+        finally:
+            worker.cancel()
+
+    return asyncio.run(scenario())
+
+
+def test_batches_hold_at_most_ten_records_and_route_results():
+    fake = FakeAirtable()
+    ids = [f"rec{i}" for i in range(23)]
+
+    results = run_updates(fake, ids)
+
+    assert all(len(call) <= main._AIRTABLE_BATCH_SIZE for call in fake.calls)
+    assert len(fake.calls) < len(ids)
+    assert sorted(rid for call in fake.calls for rid in call) == sorted(ids)
+    for rid, fields in zip(ids, results):
+        assert fields == {"Email (from Resident)": [f"{rid}@example.com"]}
+
+
+def test_same_record_is_never_sent_twice_in_one_batch():
+    fake = FakeAirtable()
+
+    results = run_updates(fake, ["recA", "recA", "recB", "recA"])
+
+    assert all(len(call) == len(set(call)) for call in fake.calls)
+    assert not any(isinstance(r, Exception) for r in results)
+
+
+def test_rejected_record_is_retried_alone_and_fails_only_its_caller():
+    def respond(ids):
+        if "recBad" in ids:
+            return httpx.Response(422, content=orjson.dumps({"error": {"type": "INVALID_RECORDS"}}))
+        return FakeAirtable.ok(ids)
+
+    fake = FakeAirtable(respond)
+
+    results = run_updates(fake, ["recA", "recBad", "recB"])
+
+    assert fake.calls[0] == ["recA", "recBad", "recB"]
+    assert ["recBad"] in fake.calls
+    assert results[0]["Email (from Resident)"] == ["recA@example.com"]
+    assert results[2]["Email (from Resident)"] == ["recB@example.com"]
+    assert isinstance(results[1], HTTPException) and results[1].status_code == 422
+
+
+def test_missing_record_404_is_retried_alone():
+    def respond(ids):
+        if "recGone" in ids:
+            return httpx.Response(404, content=orjson.dumps({"error": {"type": "ROW_DOES_NOT_EXIST"}}))
+        return FakeAirtable.ok(ids)
+
+    fake = FakeAirtable(respond)
+
+    results = run_updates(fake, ["recA", "recGone", "recB"])
+
+    assert ["recGone"] in fake.calls
+    assert results[0]["Email (from Resident)"] == ["recA@example.com"]
+    assert results[2]["Email (from Resident)"] == ["recB@example.com"]
+    assert isinstance(results[1], HTTPException) and results[1].status_code == 422
+
+
+def test_split_batch_retries_records_concurrently(monkeypatch):
+    # По очереди 4 одиночных PATCH по 0.12 с не уложились бы в таймаут 0.3 с
+    monkeypatch.setattr(main, "_AIRTABLE_UPDATE_TIMEOUT", 0.3)
+
+    def respond(ids):
+        if len(ids) > 1:
+            return httpx.Response(422, content=b"{}")
+        return FakeAirtable.ok(ids)
+
+    fake = FakeAirtable(respond, delay=lambda ids: 0.01 if len(ids) > 1 else 0.12)
+
+    results = run_updates(fake, ["rec1", "rec2", "rec3", "rec4"])
+
+    assert not any(isinstance(r, Exception) for r in results)
+
+
+@pytest.mark.parametrize("status", [401, 403, 429, 500, 503])
+def test_auth_rate_limit_and_server_errors_fail_whole_batch_without_splitting(status):
+    fake = FakeAirtable(lambda ids: httpx.Response(status, content=b"{}"))
+    ids = [f"rec{i}" for i in range(11)]
+
+    results = run_updates(fake, ids)
+
+    assert len(fake.calls) == 2
+    assert all(isinstance(r, HTTPException) and r.status_code == 500 for r in results)
+
+
+def test_slow_batch_does_not_block_later_updates():
+    fake = FakeAirtable(delay=lambda ids: 5.0 if "recSlow" in ids else 0.01)
+
+    async def scenario():
+        main.app.state.airtable = fake
+        main.app.state.patch_queue = asyncio.Queue()
+        worker = asyncio.create_task(main.airtable_patch_worker(main.app.state.patch_queue))
+        try:
+            slow = asyncio.create_task(main.update_airtable_record("recSlow", "1", "Paid"))
+            await asyncio.sleep(0.05)
+            fast = await asyncio.wait_for(main.update_airtable_record("recFast", "1", "Paid"), 1.0)
+            slow.cancel()
+            return fast
+        finally:
+            worker.cancel()
+
+    assert asyncio.run(scenario()) == {"Email (from Resident)": ["recFast@example.com"]}
+
+
+def test_update_gives_up_after_timeout(monkeypatch):
+    monkeypatch.setattr(main, "_AIRTABLE_UPDATE_TIMEOUT", 0.05)
+    fake = FakeAirtable(delay=5.0)
+
+    results = run_updates(fake, ["recA"])
+
+    assert isinstance(results[0], HTTPException) and results[0].status_code == 500
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    monkeypatch.setattr(main, "_email_cache", main.OrderedDict())
+    monkeypatch.setattr(main, "_email_locks", {})
+
+
+def test_record_lock_serializes_duplicates_and_cleans_up():
+    active = 0
+    peak = 0
+
+    async def handle():
+        nonlocal active, peak
+        async with main.record_lock("rec1"):
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    async def scenario():
+        # Первый держатель отпускает lock, пока остальные ещё ждут,
+        # а новые дубли приходят уже после этого
+        first = [asyncio.create_task(handle()) for _ in range(3)]
+        await asyncio.sleep(0.015)
+        late = [asyncio.create_task(handle()) for _ in range(3)]
+        await asyncio.gather(*first, *late)
+
+    asyncio.run(scenario())
+    assert peak == 1
+    assert main._email_locks == {}
+
+
+def test_record_lock_cleans_up_on_error():
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            async with main.record_lock("rec1"):
+                raise RuntimeError
+
+    asyncio.run(scenario())
+    assert main._email_locks == {}
+
+
+def test_cache_matches_amount_and_status():
+    main.cache_email("rec1", "10.00", "Paid", "a@example.com")
+    assert main.get_cached_email("rec1", "10.00", "Paid") == "a@example.com"
+    assert main.get_cached_email("rec1", "20.00", "Paid") is None
+    assert main.get_cached_email("rec1", "10.00", "Test Paid") is None
+    assert main.get_cached_email("rec2", "10.00", "Paid") is None
+
+
+def test_cache_expires(monkeypatch):
+    monkeypatch.setattr(main, "_EMAIL_CACHE_TTL", -1.0)
+    main.cache_email("rec1", "10.00", "Paid", "a@example.com")
+    assert main.get_cached_email("rec1", "10.00", "Paid") is None
+
+
+def test_cache_evicts_oldest(monkeypatch):
+    monkeypatch.setattr(main, "_EMAIL_CACHE_MAX", 2)
+    main.cache_email("rec1", "1", "Paid", "1@example.com")
+    main.cache_email("rec2", "1", "Paid", "2@example.com")
+    main.cache_email("rec3", "1", "Paid", "3@example.com")
+    assert main.get_cached_email("rec1", "1", "Paid") is None
+    assert main.get_cached_email("rec3", "1", "Paid") == "3@example.com"
+
+
+def test_cache_hit_protects_entry_from_eviction(monkeypatch):
+    monkeypatch.setattr(main, "_EMAIL_CACHE_MAX", 2)
+    main.cache_email("rec1", "1", "Paid", "1@example.com")
+    main.cache_email("rec2", "1", "Paid", "2@example.com")
+    assert main.get_cached_email("rec1", "1", "Paid") == "1@example.com"
+    main.cache_email("rec3", "1", "Paid", "3@example.com")
+    assert main.get_cached_email("rec1", "1", "Paid") == "1@example.com"
+    assert main.get_cached_email("rec2", "1", "Paid") is None
@@ -0,0 +1,51 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+def signed_notification(record_id):
+    params = {
+        "MNT_ID": main.MNT_ID,
+        "MNT_TRANSACTION_ID": record_id,
+        "MNT_OPERATION_ID": "9",
+        "MNT_AMOUNT": "1500.00",
+        "MNT_CURRENCY_CODE": "RUB",
+        "MNT_SUBSCRIBER_ID": "",
+        "MNT_TEST_MODE": "0",
+    }
+    params["MNT_SIGNATURE"] = main.calculate_signature(
+        record_id, "9", "1500.00", "RUB", "", "0"
+    ).hex()
+    return params
+
+
+def test_missing_email_after_update_answers_xml_fail(monkeypatch):
+    updates = []
+
+    async def update_airtable_record(record_id, amount, status):
+        updates.append(record_id)
+        return {"Status": status}
+
+    monkeypatch.setattr(main, "update_airtable_record", update_airtable_record)
+    monkeypatch.setattr(main, "_email_cache", main.OrderedDict())
+
+    resp = TestClient(main.app).post("/webhook", json=signed_notification("recNoEmail"))
+
+    assert updates == ["recNoEmail"]
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/xml"
+    assert "<MNT_RESULT_CODE>500</MNT_RESULT_CODE>" in resp.text
+    assert "recNoEmail" not in main._email_cache
+
+
+def test_update_with_email_answers_customer(monkeypatch):
+    async def update_airtable_record(record_id, amount, status):
+        return {"Email (from Resident)": ["a@example.com"]}
+
+    monkeypatch.setattr(main, "update_airtable_record", update_airtable_record)
+    monkeypatch.setattr(main, "_email_cache", main.OrderedDict())
+
+    resp = TestClient(main.app).post("/webhook", json=signed_notification("recOk"))
+
+    assert "<MNT_RESULT_CODE>200</MNT_RESULT_CODE>" in resp.text
+    assert "a@example.com" in resp.text